@@ -9,12 +9,20 @@ Crea Work Items automáticamente con detalles consumidos de los mails
 
 import imaplib
 import email
+import orjson
 import requests
+from requests.adapters import HTTPAdapter, Retry
 import base64
+import logging
+import select
+import signal
+import sqlite3
+import threading
 import time
 import json
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from email.header import decode_header
 from urllib.parse import quote
 from dotenv import load_dotenv
@@ -31,6 +39,8 @@ config = {
     "azure_project": os.getenv("AZURE_PROJECT"),
     "azure_pat": os.getenv("AZURE_PAT"),
     "log_file": os.getenv("LOG_FILE", "monitor_correos.log"),
+    "uid_state_file": os.getenv("UID_STATE_FILE", "estado_uid.json"),
+    "processed_db_file": os.getenv("PROCESSED_DB_FILE", "procesados.db"),
     "monitored_senders": os.getenv("MONITORED_SENDERS", "azuredevops@microsoft.com").split(","),
     "check_interval": int(os.getenv("CHECK_INTERVAL", "60"))
 }
@@ -41,6 +51,32 @@ for clave in config_requerida:
     if not config[clave]:
         raise ValueError(f"Configuración faltante: {clave.upper()}")
 
+# Renovar IDLE antes de los ~10 minutos tras los cuales algunos servidores
+# (Gmail entre ellos) cortan la sesión
+INTERVALO_RENOVACION_IDLE = 540
+
+# Señal de apagado: SIGTERM/SIGINT la activan para cortar las esperas
+# del bucle principal y cerrar la sesión IMAP de forma ordenada
+_detener = threading.Event()
+
+
+def _solicitar_detencion(*_args):
+    _detener.set()
+
+# Tipos y estados de Azure DevOps cambian a escala humana (días):
+# cachearlos una hora evita un round-trip HTTP por correo procesado
+TTL_CACHE_METADATOS = 3600
+
+# Hilos para procesar correos en paralelo: el trabajo por correo son
+# llamadas HTTPS independientes; 8 mantiene la carga bajo los límites
+# de throttling de Azure DevOps
+MAX_HILOS_PROCESAMIENTO = 8
+
+# Correos por lote de FETCH/procesamiento: acota la memoria pico con
+# buzones atrasados y permite crear los primeros work items sin esperar
+# a descargar todo el backlog
+TAMANO_LOTE_CORREOS = 50
+
 # Mapeos personalizados para el tablero
 MAPEO_TABLERO = {
     "columnas_estados": {
@@ -50,6 +86,10 @@ MAPEO_TABLERO = {
     }
 }
 
+# Vista directa del mapeo columna → estado: evita repetir la
+# indirección por MAPEO_TABLERO en cada correo procesado
+_COLUMNAS_ESTADOS = MAPEO_TABLERO["columnas_estados"]
+
 # Mapeo de remitentes a columnas y patrones
 MAPEO_REMITENTES = {
     "azuredevops@microsoft.com": {
@@ -64,6 +104,30 @@ MAPEO_REMITENTES = {
     }
 }
 
+def _compilar_clasificador(mapeo):
+    """Compila los patrones de asunto de un mapeo en un solo regex"""
+    patrones = sorted(mapeo, key=len, reverse=True)
+    return re.compile("|".join(re.escape(patron) for patron in patrones), re.IGNORECASE)
+
+
+# Clasificadores precompilados: una sola pasada por el asunto en lugar
+# de un escaneo con `in` por cada patrón del mapeo
+_CLASIFICADORES_REMITENTE = {
+    remitente: _compilar_clasificador(mapeo)
+    for remitente, mapeo in MAPEO_REMITENTES.items()
+}
+
+# UID dentro del encabezado de una respuesta FETCH, p. ej.
+# b'12 (UID 457 BODY[HEADER.FIELDS (SUBJECT)] {48}'
+_RE_UID_RESPUESTA = re.compile(rb'\bUID (\d+)')
+
+# Patrones genéricos cuando ningún patrón específico del remitente coincide
+_PATRONES_GENERICOS = [
+    (re.compile(r"failed|failure|error|falló|fallo|fallida", re.IGNORECASE), "Bugs creados", "failed"),
+    (re.compile(r"succeeded|success|exitoso|completado|exitosa", re.IGNORECASE), "Ejecucion existosa", "success"),
+    (re.compile(r"warning|unstable|advertencia|inestable", re.IGNORECASE), "En revision", "warning")
+]
+
 # Plantillas para detalles específicos por herramienta
 PLANTILLAS_DETALLES = {
     "azuredevops@microsoft.com": {
@@ -77,20 +141,92 @@ PLANTILLAS_DETALLES = {
     }
 }
 
+# Estructura del JSON-patch de creación de work items: solo cambian los
+# valores de título, descripción y estado, así que se arma una sola vez
+# y cada llamada completa copias (varios hilos crean elementos a la vez)
+_PLANTILLA_CAMPOS = [
+    {"op": "add", "path": "/fields/System.Title", "value": None},
+    {"op": "add", "path": "/fields/System.Description", "value": None},
+    {"op": "add", "path": "/fields/System.State", "value": None},
+    {"op": "add", "path": "/fields/System.Tags", "value": "Auto-Generado"}
+]
+
+
+class _FormateadorJSON(logging.Formatter):
+    """Emite cada registro como una línea JSON, parseable sin regex"""
+    def format(self, record):
+        registro = {
+            "marca_tiempo": self.formatTime(record, "%d-%m-%Y %H:%M:%S"),
+            "emoji": getattr(record, "emoji", "📝"),
+            "mensaje": record.getMessage()
+        }
+        registro.update(getattr(record, "datos", None) or {})
+        return json.dumps(registro, ensure_ascii=False)
+
 
 class Logger:
     """Manejador de logs"""
     def __init__(self, archivo_log):
         self.archivo_log = archivo_log
-        
-    def registrar(self, mensaje, emoji="📝"):
-        
-        marca_tiempo = time.strftime("%d-%m-%Y %H:%M:%S")
-        linea = f"[{marca_tiempo}] {emoji} {mensaje}"
-        
-        with open(self.archivo_log, "a", encoding="utf-8") as f:
-            f.write(linea + "\n")
-        print(linea)
+
+        # Un FileHandler mantiene el archivo abierto con escritura
+        # bufferizada, en vez de un open/close por cada mensaje.
+        # El archivo recibe líneas JSON (para grep/ELK); la consola
+        # conserva el formato legible con emojis
+        self._logger = logging.getLogger("monitor_correos")
+        self._logger.setLevel(logging.INFO)
+        self._logger.propagate = False
+        if not self._logger.handlers:
+            manejador_archivo = logging.FileHandler(archivo_log, encoding="utf-8")
+            manejador_archivo.setFormatter(_FormateadorJSON())
+            self._logger.addHandler(manejador_archivo)
+
+            manejador_consola = logging.StreamHandler()
+            manejador_consola.setFormatter(
+                logging.Formatter("[%(asctime)s] %(emoji)s %(message)s", "%d-%m-%Y %H:%M:%S")
+            )
+            self._logger.addHandler(manejador_consola)
+
+    def registrar(self, mensaje, emoji="📝", datos=None):
+        self._logger.info(mensaje, extra={"emoji": emoji, "datos": datos})
+
+
+class RegistroProcesados:
+    """Registro persistente de correos ya convertidos en work items.
+
+    Si el monitor se reinicia después de marcar un correo como leído
+    pero antes de crear su elemento (o viceversa), el Message-ID
+    guardado evita reprocesarlo o duplicar el work item.
+    """
+    def __init__(self, archivo_db="procesados.db"):
+        self._conexion = sqlite3.connect(archivo_db, check_same_thread=False)
+        self._conexion.execute(
+            "CREATE TABLE IF NOT EXISTS procesados (message_id TEXT PRIMARY KEY, id_elemento TEXT)"
+        )
+        self._conexion.commit()
+        # Los correos se procesan en hilos del pool: serializar el acceso
+        self._candado = threading.Lock()
+
+    def ya_procesado(self, message_id):
+        """Indica si el Message-ID ya generó un work item"""
+        if not message_id:
+            return False
+        with self._candado:
+            fila = self._conexion.execute(
+                "SELECT 1 FROM procesados WHERE message_id = ?", (message_id,)
+            ).fetchone()
+        return fila is not None
+
+    def registrar(self, message_id, id_elemento):
+        """Guarda el Message-ID junto con el work item creado"""
+        if not message_id:
+            return
+        with self._candado:
+            self._conexion.execute(
+                "INSERT OR REPLACE INTO procesados VALUES (?, ?)",
+                (message_id, str(id_elemento))
+            )
+            self._conexion.commit()
 
 
 class ClienteAzureDevOps:
@@ -103,34 +239,64 @@ class ClienteAzureDevOps:
             "Authorization": "Basic " + base64.b64encode((":" + pat).encode()).decode(),
             "Content-Type": "application/json-patch+json"
         }
-    
+        # Sesión persistente: reutiliza la conexión TCP+TLS entre llamadas
+        # y reintenta automáticamente ante errores transitorios de la API
+        self.sesion = requests.Session()
+        self.sesion.headers.update(self.encabezados)
+        self.sesion.mount("https://", HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=8,
+            max_retries=Retry(total=3, backoff_factor=0.5,
+                              status_forcelist=[429, 500, 502, 503, 504])
+        ))
+        self._cache_metadatos = {}
+
+    def _leer_cache(self, clave):
+        """Devuelve el valor cacheado para la clave si su TTL no venció"""
+        registro = self._cache_metadatos.get(clave)
+        if registro and time.monotonic() - registro[0] < TTL_CACHE_METADATOS:
+            return registro[1]
+        return None
+
+    def _guardar_cache(self, clave, valor):
+        """Guarda un valor en el cache con la marca de tiempo actual"""
+        self._cache_metadatos[clave] = (time.monotonic(), valor)
+
     def obtener_tipos_elementos(self):
         """Obtiene los tipos de elementos de trabajo disponibles"""
+        tipos = self._leer_cache("tipos")
+        if tipos is not None:
+            return tipos
         try:
             proyecto_codificado = quote(self.proyecto)
             url = f"{self.org}/{proyecto_codificado}/_apis/wit/workitemtypes?api-version=6.0"
-            
-            respuesta = requests.get(url, headers=self.encabezados, timeout=30)
-            
+
+            respuesta = self.sesion.get(url, timeout=30)
+
             if respuesta.status_code == 200:
-                tipos = [tipo['name'] for tipo in respuesta.json()['value']]
+                tipos = [tipo['name'] for tipo in orjson.loads(respuesta.content)['value']]
+                self._guardar_cache("tipos", tipos)
                 return tipos
-            return ["Issue", "Task"] 
+            return ["Issue", "Task"]
         except Exception as error:
             print(f"Error obteniendo tipos: {error}")
-            return ["Issue", "Task"]  
-    
+            return ["Issue", "Task"]
+
     def obtener_estados_elemento(self, tipo_elemento):
         """Obtiene los estados disponibles para un tipo de elemento"""
+        estados = self._leer_cache(("estados", tipo_elemento))
+        if estados is not None:
+            return estados
         try:
             proyecto_codificado = quote(self.proyecto)
             url = f"{self.org}/{proyecto_codificado}/_apis/wit/workitemtypes/{tipo_elemento}/states?api-version=6.0"
-            
-            respuesta = requests.get(url, headers=self.encabezados, timeout=30)
-            
+
+            respuesta = self.sesion.get(url, timeout=30)
+
             if respuesta.status_code == 200:
-                estados = [estado['name'] for estado in respuesta.json()['value']]
-                # print(f"🎯 Estados REALES para '{tipo_elemento}': {estados}") 
+                estados = [estado['name'] for estado in orjson.loads(respuesta.content)['value']]
+                # print(f"🎯 Estados REALES para '{tipo_elemento}': {estados}")
+                self._guardar_cache(("estados", tipo_elemento), estados)
                 return estados
             return ["To Do", "Doing", "Done"]
         except Exception as error:
@@ -184,26 +350,16 @@ class ClienteAzureDevOps:
             url = f"{self.org}/{proyecto_codificado}/_apis/wit/workitems/${tipo_elemento}?api-version=6.0"
             
             # Determinar estado según la columna destino
-            estado = MAPEO_TABLERO["columnas_estados"].get(columna_destino, "To Do")
-            
-            # Verificar que el estado existe para este tipo de elemento
-            estados_disponibles = self.obtener_estados_elemento(tipo_elemento)
-            if estado not in estados_disponibles:
-                print(f"⚠️ Estado '{estado}' no disponible para {tipo_elemento}. Estados disponibles: {estados_disponibles}")
-                # Usar el primer estado disponible como fallback
-                estado = estados_disponibles[0] if estados_disponibles else "To Do"
-                print(f"⚠️ Usando estado por defecto: {estado}")
-            
+            estado = _COLUMNAS_ESTADOS.get(columna_destino, "To Do")
+
             # Construir descripción con detalles
             descripcion = self._construir_descripcion(columna_destino, detalles, remitente)
             
             # Datos para crear el elemento
-            datos = [
-                {"op": "add", "path": "/fields/System.Title", "value": titulo},
-                {"op": "add", "path": "/fields/System.Description", "value": descripcion},
-                {"op": "add", "path": "/fields/System.State", "value": estado},
-                {"op": "add", "path": "/fields/System.Tags", "value": "Auto-Generado"}
-            ]
+            datos = [dict(campo) for campo in _PLANTILLA_CAMPOS]
+            datos[0]["value"] = titulo
+            datos[1]["value"] = descripcion
+            datos[2]["value"] = estado
             
             # Agregar campo personalizado para remitente si existe
             if remitente:
@@ -213,10 +369,25 @@ class ClienteAzureDevOps:
                     "value": f"Generado desde: {remitente}"
                 })
             
-            respuesta = requests.post(url, headers=self.encabezados, json=datos, timeout=30)
-            
+            # orjson serializa directo a bytes; el Content-Type
+            # json-patch ya viene fijado en los encabezados de la sesión
+            respuesta = self.sesion.post(url, data=orjson.dumps(datos), timeout=30)
+
+            # El estado mapeado casi siempre existe: se envía de forma
+            # optimista y solo si la API lo rechaza (400 sobre
+            # System.State) se consultan los estados disponibles para
+            # elegir un fallback y reintentar una única vez
+            if respuesta.status_code == 400 and "System.State" in respuesta.text:
+                estados_disponibles = self.obtener_estados_elemento(tipo_elemento)
+                if estados_disponibles and estado not in estados_disponibles:
+                    print(f"⚠️ Estado '{estado}' no disponible para {tipo_elemento}. Estados disponibles: {estados_disponibles}")
+                    estado = estados_disponibles[0]
+                    print(f"⚠️ Reintentando con estado: {estado}")
+                    datos[2]["value"] = estado
+                    respuesta = self.sesion.post(url, data=orjson.dumps(datos), timeout=30)
+
             if respuesta.status_code in [200, 201]:
-                id_elemento = respuesta.json().get('id', 'N/A')
+                id_elemento = orjson.loads(respuesta.content).get('id', 'N/A')
                 url_elemento = f"{self.org}/{self.proyecto}/_workitems/edit/{id_elemento}"
                 return True, id_elemento, url_elemento, estado
             else:
@@ -311,22 +482,122 @@ class ClienteAzureDevOps:
 
 class ProcesadorCorreos:
     """Procesa correos electrónicos y extrae información relevante"""
-    def __init__(self, servidor, usuario, contraseña):
+    def __init__(self, servidor, usuario, contraseña, archivo_estado="estado_uid.json"):
         self.servidor = servidor
         self.usuario = usuario
         self.contraseña = contraseña
-    
+        self.archivo_estado = archivo_estado
+        self.uidvalidity = 0
+        self.ultimo_uid = 0
+
     def conectar(self):
         """Establece conexión con el servidor IMAP"""
         try:
             cliente = imaplib.IMAP4_SSL(self.servidor)
             cliente.login(self.usuario, self.contraseña)
             cliente.select("inbox")
+
+            # Recuperar el último UID revisado para buscar solo desde ahí;
+            # si UIDVALIDITY cambió, los UIDs guardados ya no valen
+            respuesta = cliente.response('UIDVALIDITY')[1]
+            self.uidvalidity = int(respuesta[0]) if respuesta and respuesta[0] else 0
+            self.ultimo_uid = self._cargar_estado_uid(self.uidvalidity)
             return cliente
         except Exception as error:
             print(f"Error conectando al servidor: {error}")
             return None
+
+    def _cargar_estado_uid(self, uidvalidity):
+        """Lee de disco el último UID procesado para este buzón"""
+        try:
+            with open(self.archivo_estado, encoding="utf-8") as f:
+                estado = json.load(f)
+            if estado.get("uidvalidity") == uidvalidity:
+                return estado.get("ultimo_uid", 0)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        return 0
+
+    def _guardar_estado_uid(self):
+        """Persiste el último UID procesado junto con el UIDVALIDITY"""
+        try:
+            with open(self.archivo_estado, "w", encoding="utf-8") as f:
+                json.dump({"uidvalidity": self.uidvalidity, "ultimo_uid": self.ultimo_uid}, f)
+        except Exception as error:
+            print(f"Error guardando estado de UID: {error}")
+
+    def actualizar_ultimo_uid(self, ids_mensajes):
+        """Avanza la marca de agua al UID más alto ya revisado"""
+        if not ids_mensajes:
+            return
+        maximo = max(int(uid) for uid in ids_mensajes)
+        if maximo > self.ultimo_uid:
+            self.ultimo_uid = maximo
+            self._guardar_estado_uid()
     
+    def soporta_idle(self, cliente):
+        """Indica si el servidor soporta el comando IDLE (RFC 2177)"""
+        try:
+            return "IDLE" in cliente.capabilities
+        except Exception:
+            return False
+
+    def esperar_nuevos_correos(self, cliente, tiempo_maximo):
+        """Espera en IDLE a que el servidor notifique correos nuevos.
+
+        Mantiene el comando IDLE activo hasta que llegue una respuesta
+        EXISTS/RECENT o se agote tiempo_maximo (para renovar el comando
+        antes de que el servidor corte la sesión). Devuelve True si el
+        servidor anunció novedades.
+        """
+        etiqueta = cliente._new_tag()
+        cliente.send(etiqueta + b' IDLE\r\n')
+        hay_novedades = False
+        try:
+            # Esperar datos con select en tramos cortos (así se atiende
+            # la señal de apagado) y recién entonces hacer el readline
+            # bloqueante: un timeout sobre el buffer de makefile puede
+            # descartar una línea leída a medias
+            limite = time.monotonic() + tiempo_maximo
+            while time.monotonic() < limite and not _detener.is_set():
+                if not self._hay_datos_disponibles(cliente, 5):
+                    continue
+                linea = cliente.readline()
+                if not linea:
+                    raise imaplib.IMAP4.abort("Conexión IDLE cerrada por el servidor")
+                linea = linea.strip().upper()
+                if linea.endswith(b'EXISTS') or linea.endswith(b'RECENT'):
+                    hay_novedades = True
+                    break
+        finally:
+            # La respuesta al tag se consume a mano: sacarlo del registro
+            # de imaplib para no acumular una entrada por cada renovación
+            cliente.tagged_commands.pop(etiqueta, None)
+            cliente.send(b'DONE\r\n')
+            # Drenar la respuesta a DONE con espera acotada: si el
+            # servidor dejó de responder no se bloquea el apagado
+            vencimiento = time.monotonic() + 30
+            while time.monotonic() < vencimiento:
+                if not self._hay_datos_disponibles(cliente, 5):
+                    continue
+                respuesta = cliente.readline()
+                if not respuesta or respuesta.startswith(etiqueta):
+                    break
+        return hay_novedades
+
+    @staticmethod
+    def _hay_datos_disponibles(cliente, tiempo_espera):
+        """Indica si hay datos por leer sin que readline bloquee.
+
+        Consulta primero el buffer TLS (select no ve los bytes ya
+        descifrados) y después espera actividad en el socket crudo.
+        """
+        pendiente = getattr(cliente.sock, "pending", None)
+        if pendiente and pendiente():
+            return True
+        legibles, _, _ = select.select([cliente.sock], [], [], tiempo_espera)
+        return bool(legibles)
+
     def buscar_correos_monitoreados(self, cliente, remitentes):
         """Busca correos no leídos de múltiples remitentes monitoreados"""
         try:
@@ -337,89 +608,166 @@ class ProcesadorCorreos:
                 if not remitente_limpio:
                     continue
                     
-                criterio = f'(UNSEEN FROM "{remitente_limpio}")'
-                estado, mensajes = cliente.search(None, criterio)
-                
+                # UID n:* es una consulta indexada en el servidor: evita
+                # reescanear todo el buzón en cada ciclo
+                criterio = f'(UID {self.ultimo_uid + 1}:* UNSEEN FROM "{remitente_limpio}")'
+                estado, mensajes = cliente.uid('SEARCH', None, criterio)
+
                 if estado == "OK" and mensajes[0]:
-                    correos_remitente = mensajes[0].split()
-                    todos_correos.extend([(msg_id, remitente_limpio) for msg_id in correos_remitente])
-            
+                    # UID n:* siempre incluye el último mensaje del buzón
+                    # aunque su UID sea menor que n: filtrarlo
+                    correos_remitente = [
+                        uid for uid in mensajes[0].split()
+                        if int(uid) > self.ultimo_uid
+                    ]
+                    todos_correos.extend([(uid, remitente_limpio) for uid in correos_remitente])
+
+            # Orden global ascendente por UID: la lista viene concatenada
+            # por remitente y los lotes avanzan una única marca de agua,
+            # así que un lote no puede contener UIDs menores que uno ya
+            # procesado o el corte entre lotes los dejaría bajo la marca
+            todos_correos.sort(key=lambda correo: int(correo[0]))
             return todos_correos
         except Exception as error:
             print(f"Error buscando correos: {error}")
             return []
+
+    def obtener_asuntos(self, cliente, ids_mensajes):
+        """Obtiene solo el asunto de un conjunto de correos en un FETCH.
+
+        BODY.PEEK evita transferir el cuerpo completo (las notificaciones
+        HTML pueden pesar decenas de KB) y no marca \\Seen implícito: el
+        marcado explícito de marcar_leidos sigue siendo la única fuente.
+        """
+        if not ids_mensajes:
+            return {}
+        try:
+            estado, datos = cliente.uid(
+                'FETCH', b','.join(ids_mensajes).decode(),
+                "(BODY.PEEK[HEADER.FIELDS (SUBJECT)])"
+            )
+            if estado != "OK":
+                return {}
+
+            asuntos = {}
+            for parte in datos:
+                if isinstance(parte, tuple):
+                    id_mensaje = self._extraer_uid(parte[0])
+                    encabezados = email.message_from_bytes(parte[1])
+                    asuntos[id_mensaje] = self.decodificar_asunto(encabezados["subject"])
+            return asuntos
+        except Exception as error:
+            print(f"Error obteniendo asuntos: {error}")
+            return {}
+
+    def obtener_correos_crudos(self, cliente, ids_mensajes):
+        """Descarga varios correos en un solo FETCH usando un set de ids"""
+        if not ids_mensajes:
+            return {}
+        try:
+            estado, datos = cliente.uid(
+                'FETCH', b','.join(ids_mensajes).decode(), "(BODY.PEEK[])"
+            )
+            if estado != "OK":
+                return {}
+
+            correos = {}
+            for parte in datos:
+                if isinstance(parte, tuple):
+                    id_mensaje = self._extraer_uid(parte[0])
+                    correos[id_mensaje] = parte[1]
+            return correos
+        except Exception as error:
+            print(f"Error descargando correos: {error}")
+            return {}
+
+    def marcar_leidos(self, cliente, ids_mensajes):
+        """Marca un conjunto de correos como leídos en una sola llamada"""
+        try:
+            if ids_mensajes:
+                cliente.uid('STORE', b','.join(ids_mensajes).decode(), '+FLAGS', '\\Seen')
+        except Exception as error:
+            print(f"Error marcando correos como leídos: {error}")
+
+    @staticmethod
+    def _extraer_uid(encabezado_respuesta):
+        """Obtiene el UID desde el encabezado de una respuesta a UID FETCH.
+
+        El encabezado tiene la forma b'12 (UID 457 BODY[...] {48}': el
+        primer token es el número de secuencia, no el UID, y 'UID' llega
+        pegado al paréntesis, por eso se busca con regex.
+        """
+        coincidencia = _RE_UID_RESPUESTA.search(encabezado_respuesta)
+        if coincidencia:
+            return coincidencia.group(1)
+        return encabezado_respuesta.split()[0]
     
     def decodificar_asunto(self, asunto_codificado):
         """Decodifica el asunto del mail"""
         try:
-            partes_decodificadas = decode_header(asunto_codificado)
-            asunto = ""
-            for parte, codificacion in partes_decodificadas:
+            partes = []
+            for parte, codificacion in decode_header(asunto_codificado):
                 if isinstance(parte, bytes):
-                    asunto += parte.decode(codificacion if codificacion else 'utf-8', errors='ignore')
+                    partes.append(parte.decode(codificacion if codificacion else 'utf-8', errors='ignore'))
                 else:
-                    asunto += parte
-            return asunto
-        except:
+                    partes.append(parte)
+            return "".join(partes)
+        except Exception:
             return str(asunto_codificado)
     
     def determinar_accion_por_remitente(self, asunto, remitente):
         """Determina la accion segun el remitente y el asunto"""
-        asunto_lower = asunto.lower()
         remitente_limpio = remitente.strip().lower()
-        
+
         # Buscar mapeo por remitente
-        mapeo_remitente = None
+        remitente_encontrado = "azuredevops@microsoft.com"
         for remitente_mapeo in MAPEO_REMITENTES:
             if remitente_mapeo.lower() in remitente_limpio:
-                mapeo_remitente = MAPEO_REMITENTES[remitente_mapeo]
+                remitente_encontrado = remitente_mapeo
                 break
-        
+
         # Si no hay mapeo específico, usar mapeo por defecto
-        if not mapeo_remitente:
-            mapeo_remitente = MAPEO_REMITENTES.get("azuredevops@microsoft.com", {})
-        
-        # Buscar patrones en el asunto
-        for patron, columna in mapeo_remitente.items():
-            if patron in asunto_lower:
-                return columna, patron
-                
+        mapeo_remitente = MAPEO_REMITENTES[remitente_encontrado]
+
+        # Buscar patrones del remitente en el asunto (regex precompilado)
+        coincidencia = _CLASIFICADORES_REMITENTE[remitente_encontrado].search(asunto)
+        if coincidencia:
+            patron = coincidencia.group(0).lower()
+            return mapeo_remitente[patron], patron
+
         # Patrones genéricos si no hay coincidencia específica
-        if any(p in asunto_lower for p in ["failed", "failure", "error", "falló", "fallo", "fallida"]):
-            return "Bugs creados", "failed"
-        elif any(p in asunto_lower for p in ["succeeded", "success", "exitoso", "completado", "exitosa"]):
-            return "Ejecucion existosa", "success"
-        elif any(p in asunto_lower for p in ["warning", "unstable", "advertencia", "inestable"]):
-            return "En revision", "warning"
-            
+        for patron_generico, columna, tipo_evento in _PATRONES_GENERICOS:
+            if patron_generico.search(asunto):
+                return columna, tipo_evento
+
         return None, None
 
-    def procesar_correo(self, cliente, id_mensaje, remitente, cliente_azure, logger):
+    def procesar_correo(self, correo_crudo, remitente, cliente_azure, logger, registro_procesados=None):
         """Procesa un correo individual considerando el remitente"""
         try:
-            estado, datos = cliente.fetch(id_mensaje, "(RFC822)")
-            if estado != "OK":
-                return
-            
-            mensaje = email.message_from_bytes(datos[0][1])
+            mensaje = email.message_from_bytes(correo_crudo)
             asunto = self.decodificar_asunto(mensaje["subject"])
-            
+            message_id = mensaje["Message-ID"]
+
+            if registro_procesados and registro_procesados.ya_procesado(message_id):
+                logger.registrar(f"Correo de {remitente} ya procesado en una corrida anterior: {asunto}", "📨")
+                return
+
             logger.registrar(f"Procesando correo de {remitente}: {asunto}", "📧")
-            
-            # Extraer detalles del correo
-            detalles = cliente_azure.extraer_detalles_correo(mensaje)
-            detalles['remitente'] = remitente
-            
-            # Marcar como leído
-            cliente.store(id_mensaje, '+FLAGS', '\\Seen')
-            
-            # Determinar acción basada en remitente y asunto
+
+            # Determinar acción basada en remitente y asunto, antes de
+            # parsear el cuerpo o tocar la API
             columna, tipo_evento = self.determinar_accion_por_remitente(asunto, remitente)
-            
+
             if not columna:
                 logger.registrar(f"Correo de {remitente} no requiere acción: {asunto}", "📨")
                 return
-            
+
+            # Extraer detalles del correo
+            detalles = cliente_azure.extraer_detalles_correo(mensaje)
+            detalles['remitente'] = remitente
+
+
             # Determinar tipo de elemento
             tipos_disponibles = cliente_azure.obtener_tipos_elementos()
             
@@ -448,17 +796,103 @@ class ProcesadorCorreos:
             )
             
             if exito:
-                logger.registrar(f"Elemento #{id_elemento} creado en '{columna}'", "✅")
-                logger.registrar(f"Remitente: {remitente}", "👤")
-                logger.registrar(f"Tipo evento: {tipo_evento}", "🎯")
-                logger.registrar(f"URL: {url}", "🔗")
+                if registro_procesados:
+                    registro_procesados.registrar(message_id, id_elemento)
+                logger.registrar(f"Elemento #{id_elemento} creado en '{columna}'", "✅", datos={
+                    "evento": "elemento_creado",
+                    "id_elemento": id_elemento,
+                    "columna": columna,
+                    "estado": estado,
+                    "remitente": remitente,
+                    "tipo_evento": tipo_evento,
+                    "url": url
+                })
             else:
-                logger.registrar("No se pudo crear el elemento", "❌")
+                logger.registrar("No se pudo crear el elemento", "❌", datos={
+                    "evento": "creacion_fallida",
+                    "remitente": remitente,
+                    "tipo_evento": tipo_evento
+                })
                 
         except Exception as error:
             logger.registrar(f"Error procesando correo de {remitente}: {error}", "❌")
 
 
+def procesar_lote(cliente_imap, lote, procesador_correos, cliente_azure, logger, registro_procesados):
+    """Clasifica y procesa un lote de correos encontrados.
+
+    Clasifica por asunto con un FETCH liviano de encabezados, descarga
+    el cuerpo completo solo de los accionables y los procesa en
+    paralelo con un pool de hilos.
+    """
+    ids_correos = [id_correo for id_correo, _ in lote]
+    asuntos = procesador_correos.obtener_asuntos(cliente_imap, ids_correos)
+
+    # Un FETCH fallido o vacío no debe marcar nada como leído ni avanzar
+    # la marca de agua: se aborta el lote para reintentarlo al próximo ciclo
+    if not asuntos:
+        raise imaplib.IMAP4.error(
+            f"FETCH de encabezados sin respuesta para {len(ids_correos)} correos"
+        )
+
+    faltantes = [id_correo for id_correo in ids_correos if id_correo not in asuntos]
+    if faltantes:
+        logger.registrar(
+            f"{len(faltantes)} correos sin encabezado en la respuesta FETCH; se reintentarán", "⚠️"
+        )
+
+    accionables = []
+    for id_correo, remitente in lote:
+        asunto = asuntos.get(id_correo)
+        if asunto is None:
+            continue
+        columna, _ = procesador_correos.determinar_accion_por_remitente(asunto, remitente)
+        if columna:
+            accionables.append((id_correo, remitente))
+        else:
+            logger.registrar(f"Correo de {remitente} no requiere acción: {asunto}", "📨")
+
+    correos_crudos = procesador_correos.obtener_correos_crudos(
+        cliente_imap, [id_correo for id_correo, _ in accionables]
+    )
+
+    # Un accionable sin cuerpo en la respuesta cuenta como faltante: no
+    # se marca ni se avanza por encima de él, y la próxima búsqueda lo
+    # vuelve a encontrar
+    sin_cuerpo = [id_correo for id_correo, _ in accionables if id_correo not in correos_crudos]
+    if sin_cuerpo:
+        logger.registrar(
+            f"{len(sin_cuerpo)} correos sin cuerpo en la respuesta FETCH; se reintentarán", "⚠️"
+        )
+        faltantes = faltantes + sin_cuerpo
+
+    # Marcar y avanzar solo sobre lo efectivamente recibido, recién
+    # cuando ambos FETCH respondieron; la marca de agua no puede saltar
+    # por encima de un UID todavía pendiente
+    pendientes = set(faltantes)
+    confirmados = [id_correo for id_correo in ids_correos if id_correo not in pendientes]
+    procesador_correos.marcar_leidos(cliente_imap, confirmados)
+    if faltantes:
+        menor_faltante = min(int(uid) for uid in faltantes)
+        avanzables = [uid for uid in confirmados if int(uid) < menor_faltante]
+    else:
+        avanzables = confirmados
+    procesador_correos.actualizar_ultimo_uid(avanzables)
+
+    # El procesamiento de cada correo es I/O independiente
+    # (solo HTTPS hacia Azure DevOps): paralelizar con hilos
+    if accionables:
+        with ThreadPoolExecutor(max_workers=MAX_HILOS_PROCESAMIENTO) as ejecutor:
+            for id_correo, remitente in accionables:
+                correo_crudo = correos_crudos.get(id_correo)
+                if correo_crudo:
+                    ejecutor.submit(
+                        procesador_correos.procesar_correo,
+                        correo_crudo, remitente, cliente_azure, logger,
+                        registro_procesados
+                    )
+
+
 def main():
     """Inicio"""
     logger = Logger(config["log_file"])
@@ -467,45 +901,90 @@ def main():
     
     # Muestra informacion del mapeo al tablero
     logger.registrar("🎯 Configuración del tablero:", "⚙️")
-    for columna, estado in MAPEO_TABLERO["columnas_estados"].items():
+    for columna, estado in _COLUMNAS_ESTADOS.items():
         logger.registrar(f"  {columna} → {estado}")
     
     # Inicializar clientes
     cliente_azure = ClienteAzureDevOps(config["azure_org"], config["azure_project"], config["azure_pat"])
-    procesador_correos = ProcesadorCorreos(config["imap_server"], config["imap_user"], config["imap_pass"])
+    procesador_correos = ProcesadorCorreos(
+        config["imap_server"], config["imap_user"], config["imap_pass"],
+        config["uid_state_file"]
+    )
+    registro_procesados = RegistroProcesados(config["processed_db_file"])
     
-    while True:
+    # Apagado ordenado: las señales activan el evento y las esperas se
+    # cortan de inmediato en lugar de agotar el sleep completo
+    signal.signal(signal.SIGTERM, _solicitar_detencion)
+    signal.signal(signal.SIGINT, _solicitar_detencion)
+
+    cliente_imap = None
+    espera_reconexion = 1
+
+    while not _detener.is_set():
         try:
-            # Conectar y procesar correos
-            cliente_imap = procesador_correos.conectar()
-            if cliente_imap:
-                # Buscar correos de todos los remitentes monitoreados
-                correos = procesador_correos.buscar_correos_monitoreados(
-                    cliente_imap, config["monitored_senders"]
-                )
-                
-                if correos:
-                    logger.registrar(f"📬 Encontrados {len(correos)} correos nuevos de {len(config['monitored_senders'])} remitentes", "📬")
-                    
-                    for id_correo, remitente in correos:
-                        procesador_correos.procesar_correo(
-                            cliente_imap, id_correo, remitente, cliente_azure, logger
-                        )
+            # Mantener una única conexión viva y reconectar solo ante errores
+            if cliente_imap is None:
+                cliente_imap = procesador_correos.conectar()
+                if not cliente_imap:
+                    logger.registrar(f"❌ No se pudo conectar al servidor IMAP, reintento en {espera_reconexion}s", "❌")
+                    _detener.wait(espera_reconexion)
+                    espera_reconexion = min(espera_reconexion * 2, 60)
+                    continue
+                espera_reconexion = 1
+                if procesador_correos.soporta_idle(cliente_imap):
+                    logger.registrar("📡 Servidor con soporte IDLE: esperando notificaciones push", "📡")
                 else:
-                    logger.registrar(f"📭 No hay correos nuevos de {len(config['monitored_senders'])} remitentes monitoreados", "📭")
-                
-                cliente_imap.close()
-                cliente_imap.logout()
+                    logger.registrar(f"⏰ Servidor sin IDLE: verificación cada {config['check_interval']} segundos", "⏰")
             else:
-                logger.registrar("❌ No se pudo conectar al servidor IMAP", "❌")
-            
-            # Esperar antes de volver a revisar
-            logger.registrar(f"⏰ Esperando {config['check_interval']} segundos para siguiente verificación", "⏰")
-            time.sleep(config["check_interval"])
-            
+                # Keepalive liviano: detecta conexiones caídas antes de buscar
+                cliente_imap.noop()
+
+            # Buscar correos de todos los remitentes monitoreados
+            correos = procesador_correos.buscar_correos_monitoreados(
+                cliente_imap, config["monitored_senders"]
+            )
+
+            if correos:
+                logger.registrar(f"📬 Encontrados {len(correos)} correos nuevos de {len(config['monitored_senders'])} remitentes", "📬")
+
+                # Trabajar en lotes acotados: con buzones muy atrasados
+                # los primeros work items se crean sin esperar a
+                # descargar el backlog completo
+                for inicio in range(0, len(correos), TAMANO_LOTE_CORREOS):
+                    if _detener.is_set():
+                        break
+                    procesar_lote(
+                        cliente_imap, correos[inicio:inicio + TAMANO_LOTE_CORREOS],
+                        procesador_correos, cliente_azure, logger, registro_procesados
+                    )
+            else:
+                logger.registrar(f"📭 No hay correos nuevos de {len(config['monitored_senders'])} remitentes monitoreados", "📭")
+
+            # Esperar novedades del servidor; si no hay IDLE, volver al sondeo
+            if procesador_correos.soporta_idle(cliente_imap):
+                procesador_correos.esperar_nuevos_correos(cliente_imap, INTERVALO_RENOVACION_IDLE)
+            else:
+                logger.registrar(f"⏰ Esperando {config['check_interval']} segundos para siguiente verificación", "⏰")
+                _detener.wait(config["check_interval"])
+
         except Exception as error:
             logger.registrar(f"❌ Error en el bucle principal: {error}", "❌")
-            time.sleep(config["check_interval"])
+            if cliente_imap:
+                try:
+                    cliente_imap.logout()
+                except Exception:
+                    pass
+                cliente_imap = None
+            _detener.wait(espera_reconexion)
+            espera_reconexion = min(espera_reconexion * 2, 60)
+
+    # Cerrar la sesión IMAP antes de salir
+    if cliente_imap:
+        try:
+            cliente_imap.logout()
+        except Exception:
+            pass
+    logger.registrar("🛑 Monitor detenido", "🛑")
 
 
 if __name__ == "__main__":
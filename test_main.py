@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Pruebas del monitor de correos."""
+
+import os
+
+# main.py valida la configuración al importarse
+os.environ.setdefault("IMAP_USER", "usuario@example.com")
+os.environ.setdefault("IMAP_PASS", "secreto")
+os.environ.setdefault("AZURE_ORG", "https://dev.azure.com/organizacion")
+os.environ.setdefault("AZURE_PROJECT", "Proyecto")
+os.environ.setdefault("AZURE_PAT", "pat")
+
+from main import ProcesadorCorreos
+
+
+class TestExtraerUid:
+    """El UID debe salir del token UID, nunca del número de secuencia"""
+
+    def test_respuesta_canonica_de_encabezados(self):
+        encabezado = b'12 (UID 457 BODY[HEADER.FIELDS (SUBJECT)] {48}'
+        assert ProcesadorCorreos._extraer_uid(encabezado) == b'457'
+
+    def test_respuesta_de_cuerpo_completo(self):
+        encabezado = b'3 (UID 98 BODY[] {10240}'
+        assert ProcesadorCorreos._extraer_uid(encabezado) == b'98'
+
+    def test_secuencia_distinta_del_uid(self):
+        # En un buzón con expunges el UID no coincide con la secuencia
+        encabezado = b'1 (UID 5021 BODY[HEADER.FIELDS (SUBJECT)] {32}'
+        assert ProcesadorCorreos._extraer_uid(encabezado) == b'5021'
+
+    def test_sin_token_uid_cae_al_primer_token(self):
+        assert ProcesadorCorreos._extraer_uid(b'7 (FLAGS (\\Seen))') == b'7'
+
+
+class _ClienteImapFalso:
+    """Devuelve resultados de UID SEARCH predefinidos por remitente"""
+
+    def __init__(self, uids_por_remitente):
+        self.uids_por_remitente = uids_por_remitente
+
+    def uid(self, comando, *args):
+        criterio = args[-1]
+        for remitente, uids in self.uids_por_remitente.items():
+            if remitente in criterio:
+                return "OK", [uids]
+        return "OK", [b'']
+
+
+class TestBuscarCorreosMonitoreados:
+    """Con varios remitentes el resultado debe quedar ordenado por UID.
+
+    Los lotes avanzan una única marca de agua: si un lote posterior
+    trajera UIDs menores que los ya procesados, un corte entre lotes
+    los dejaría bajo la marca y nunca se reintentarían.
+    """
+
+    def test_orden_global_por_uid_con_varios_remitentes(self):
+        procesador = ProcesadorCorreos("servidor", "usuario", "clave")
+        cliente = _ClienteImapFalso({
+            "a@example.com": b'900 910',
+            "b@example.com": b'100 200',
+        })
+
+        correos = procesador.buscar_correos_monitoreados(
+            cliente, ["a@example.com", "b@example.com"]
+        )
+
+        assert [int(uid) for uid, _ in correos] == [100, 200, 900, 910]
+        assert [remitente for _, remitente in correos] == [
+            "b@example.com", "b@example.com", "a@example.com", "a@example.com"
+        ]